@@ -1,13 +1,17 @@
 """Recording radiko program module"""
 
+import asyncio
 import base64
-import contextlib
+import collections
+import concurrent.futures
 import datetime
 import os
-import re
 import subprocess
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
 URL_LOGIN = 'https://radiko.jp/v4/api/member/login'
 URL_LOGOUT = 'https://radiko.jp/v4/api/member/logout'
@@ -15,9 +19,94 @@ URL_AUTH1 = 'https://radiko.jp/v2/api/auth1'
 URL_AUTH2_BASE = 'https://radiko.jp/v2/api/auth2'
 AUTHKEY_VAL = 'bcd151073c03b352e1ef2fd66c32209da9ca0afa'
 TIMEOUT = 10
+# seconds an authtoken is reused before logging in again
+AUTH_VALID_SECONDS = 3000
+# bytes of ffmpeg stderr kept in debug mode
+STDERR_TAIL_BYTES = 256 * 1024
 
-class RadikoLoginAuth(contextlib.ContextDecorator):
+_AUTHKEY = AUTHKEY_VAL.encode()
+# base64 encoded partialkey for every (keyoffset, keylength) slice of AUTHKEY_VAL
+_PARTIALKEYS = {
+    (offset, length): base64.b64encode(_AUTHKEY[offset:offset + length])
+    for offset in range(len(_AUTHKEY))
+    for length in range(1, len(_AUTHKEY) - offset + 1)
+}
+
+def _parse_yyyymmddhhmm(s: str) -> datetime.datetime:
+    """Parse a fixed-width YYYYMMDDHHMM string without strptime
+
+    Args:
+        s (str): time in format YYYYMMDDHHMM
+
+    Returns:
+        datetime.datetime: parsed time
+    """
+    return datetime.datetime(int(s[0:4]), int(s[4:6]), int(s[6:8]), int(s[8:10]), int(s[10:12]))
+
+class _StderrTail:
+    """Keep the last `limit` bytes of a stream that is read in chunks"""
+    __slots__ = ('limit', 'chunks', 'size')
+
+    def __init__(self, limit: int = STDERR_TAIL_BYTES) -> None:
+        self.limit = limit
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def append(self, chunk: bytes) -> None:
+        """Add a chunk, dropping old chunks that are no longer needed"""
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        while self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+
+    def getvalue(self) -> bytes:
+        """Return at most the last `limit` bytes"""
+        return b''.join(self.chunks)[-self.limit:]
+
+def _read_tail(stream, limit: int = STDERR_TAIL_BYTES) -> bytes:
+    """Read a binary file object until EOF and return its last `limit` bytes
+
+    Args:
+        stream: binary file object to read, e.g. Popen.stderr
+        limit (int, optional): number of bytes to keep. Defaults to STDERR_TAIL_BYTES.
+
+    Returns:
+        bytes: tail of the stream
+    """
+    tail = _StderrTail(limit)
+    while True:
+        chunk = stream.read(4096)
+        if not chunk:
+            break
+        tail.append(chunk)
+    return tail.getvalue()
+
+async def _drain_tail(stream: asyncio.StreamReader, limit: int = STDERR_TAIL_BYTES) -> bytes:
+    """Read stream until EOF and return its last `limit` bytes
+
+    Args:
+        stream (asyncio.StreamReader): stream to drain
+        limit (int, optional): number of bytes to keep. Defaults to STDERR_TAIL_BYTES.
+
+    Returns:
+        bytes: tail of the stream
+    """
+    tail = _StderrTail(limit)
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        tail.append(chunk)
+    return tail.getvalue()
+
+class RadikoLoginAuth:
     """Radiko login and authorization utility"""
+    __slots__ = (
+        'mail', 'password', 'radiko_session',
+        'authtoken', 'keyoffset', 'keylength', 'session',
+        '_auth_expiry', '_auth_lock', '_stale_sessions'
+    )
+
     def __init__(self, mail, password):
         self.mail = mail
         self.password = password
@@ -26,13 +115,26 @@ class RadikoLoginAuth(contextlib.ContextDecorator):
         self.authtoken = None
         self.keyoffset = None
         self.keylength = None
+        self._auth_expiry = 0.0
+        # serializes authorize() when recordings run concurrently
+        self._auth_lock = threading.Lock()
+        # sessions replaced by a token refresh, logged out by logout_all()
+        self._stale_sessions = []
+
+        # all endpoints live on radiko.jp, so share one keep-alive connection pool
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.headers.update({
+            "X-Radiko-Device": "pc",
+            "X-Radiko-User": "dummy_user"
+        })
 
     def __repr__(self) -> str:
         return f"RadikoLoginUtil(mail={self.mail}, password={'*'*len(self.password)})"
 
     def login(self) -> None:
         """Login to radiko"""
-        login_json = requests.post(
+        login_json = self.session.post(
             URL_LOGIN,
             data = {
                 'mail': self.mail,
@@ -47,55 +149,80 @@ class RadikoLoginAuth(contextlib.ContextDecorator):
         if not self.radiko_session or not is_areafree:
             raise PermissionError('Login failed')
 
-    def logout(self):
-        """Logout from radiko"""
-        requests.post(
+    def logout(self, radiko_session=None):
+        """Logout from radiko
+
+        Args:
+            radiko_session (str, optional): session to logout.
+                Defaults to the current session, which is then cleared.
+        """
+        self.session.post(
             URL_LOGOUT,
             data = {
-                'radiko_session': self.radiko_session,
+                'radiko_session': radiko_session or self.radiko_session,
             },
             timeout=TIMEOUT
         )
-        self.radiko_session = None
+        if radiko_session is None:
+            self.radiko_session = None
+            self._auth_expiry = 0.0
+
+    def logout_all(self):
+        """Logout the current session and every session replaced by a refresh"""
+        while self._stale_sessions:
+            self.logout(self._stale_sessions.pop())
+        if self.radiko_session is not None:
+            self.logout()
+
+    def auth1(self) -> tuple:
+        """Get authtoken, keyoffset, keylength from radiko
 
-    def auth1(self):
-        """Get authtoken, keyoffset, keylength from radiko"""
-        auth1_res = requests.get(
+        The values are only stored on self by `authorize` once auth2 has
+        activated the token, so concurrent recordings never see a token
+        that is not valid yet.
+
+        Returns:
+            tuple: authtoken, keyoffset, keylength
+        """
+        auth1_res = self.session.get(
             URL_AUTH1,
             headers = {
                 "X-Radiko-App": "pc_html5",
-                "X-Radiko-App-Version": "0.0.1",
-                "X-Radiko-Device": "pc",
-                "X-Radiko-User": "dummy_user"
+                "X-Radiko-App-Version": "0.0.1"
             },
             timeout=TIMEOUT
         ).headers
 
-        self.authtoken = auth1_res['X-Radiko-Authtoken']
-        self.keyoffset = auth1_res['X-Radiko-KeyOffset']
-        self.keylength = auth1_res['X-Radiko-KeyLength']
+        authtoken = auth1_res['X-Radiko-Authtoken']
+        keyoffset = auth1_res['X-Radiko-KeyOffset']
+        keylength = auth1_res['X-Radiko-KeyLength']
 
-        if not self.authtoken or not self.keyoffset or not self.keylength:
-            self.logout()
+        if not authtoken or not keyoffset or not keylength:
             raise PermissionError('auth1 failed')
+        return authtoken, keyoffset, keylength
+
+    def auth2(self, authtoken, keyoffset, keylength):
+        """Activate the authtoken from auth1 by sending the partialkey to radiko
 
-    def auth2(self):
-        """Get partialkey from radiko"""
+        Args:
+            authtoken (str): authtoken returned by auth1
+            keyoffset (str): keyoffset returned by auth1
+            keylength (str): keylength returned by auth1
+        """
         if self.radiko_session is None:
             raise PermissionError('Not logged in')
 
-        partialkey = base64.b64encode(
-            # vscode autocomplete
-            AUTHKEY_VAL[int(self.keyoffset):int(self.keyoffset) + int(self.keylength)].encode()
-        )
+        partialkey = _PARTIALKEYS.get((int(keyoffset), int(keylength)))
+        if partialkey is None:
+            # keyoffset/keylength outside AUTHKEY_VAL cannot be authorized
+            self.logout()
+            raise PermissionError('auth2 failed')
 
         url_auth2 = URL_AUTH2_BASE + '?radiko_session=' + self.radiko_session
-        auth2_res = requests.get(
+        auth2_res = self.session.get(
             url_auth2,
             headers = {
-                "X-Radiko-Device": "pc",
-                "X-Radiko-User": "dummy_user",
-                "X-Radiko-AuthToken": self.authtoken,
+                "X-Radiko-AuthToken": authtoken,
                 "X-Radiko-Partialkey": partialkey,
             },
             timeout=TIMEOUT
@@ -104,17 +231,54 @@ class RadikoLoginAuth(contextlib.ContextDecorator):
             self.logout()
             raise PermissionError('auth2 failed')
 
+    def authorize(self):
+        """Login and authorize, reusing the previous authtoken while it is valid
+
+        Returns:
+            str: valid authtoken, read while holding the lock
+        """
+        with self._auth_lock:
+            if self.radiko_session is not None and time.monotonic() < self._auth_expiry:
+                return self.authtoken
+            # an expired token is refreshed without logout(): recordings started
+            # with it may still be running, so the final logout is left to close()
+            if self.radiko_session is not None:
+                self._stale_sessions.append(self.radiko_session)
+
+            # auth1 does not depend on login, so overlap the two requests
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                login_future = executor.submit(self.login)
+                try:
+                    authtoken, keyoffset, keylength = self.auth1()
+                except Exception:
+                    # wait for login so that its session can be released
+                    if login_future.exception() is None:
+                        self.logout()
+                    raise
+                login_future.result()
+            self.auth2(authtoken, keyoffset, keylength)
+            self.authtoken = authtoken
+            self.keyoffset = keyoffset
+            self.keylength = keylength
+            self._auth_expiry = time.monotonic() + AUTH_VALID_SECONDS
+            return authtoken
+
+    def close(self):
+        """Close the underlying HTTP session"""
+        self.session.close()
+
     def __enter__(self):
-        self.login()
-        self.auth1()
-        self.auth2()
+        self.authorize()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.logout()
+        self.logout_all()
+        self.close()
 
 class RadikoRecorder:
     """Radiko recorder"""
+    __slots__ = ('radiko_util',)
+
     def __init__(self, mail = None, password = None) -> None:
         """Initialize RadikoRecorder
         
@@ -140,48 +304,42 @@ class RadikoRecorder:
     def __repr__(self) -> str:
         return "RadikoRecorder()"
 
+    def close(self) -> None:
+        """Logout from radiko and release the HTTP session"""
+        self.radiko_util.logout_all()
+        self.radiko_util.close()
+
     def gen_psuedo_hash(self) -> str:
         """Generate psuedo hash
         
         Returns:
             str: psuedo hash
         """
-        # Read 100 bytes from /dev/random
-        random_bytes = os.urandom(100)
-        # Encode the bytes to base64
-        # Convert the bytes to a string
-        base64_str = base64.b64encode(random_bytes).decode('utf-8')
-        # Remove all non-hexadecimal characters from the string
-        # Convert the string to lowercase
-        # Cut the string to 32 characters
-        return re.sub("[^0-9a-fA-F]", "", base64_str).lower()[:32]
+        # 16 random bytes formatted as 32 lowercase hexadecimal characters
+        return os.urandom(16).hex()
+
+    def _build_command(
+        self, station_id: str, fromtime: str, totime: str, fname: str, debug: bool
+    ) -> list:
+        """Validate the arguments, authorize and build the ffmpeg argv
 
-    def record(
-        self, station_id: str, fromtime: str, totime: str, fname: str
-    ) -> subprocess.CompletedProcess:
-        """Record radiko station from fromtime to totime to fname
-        
-        This function uses ffmpeg to record a radiko station
-        for a specified duration and save it as an m4a file.
-        
         Args:
             station_id (str): station id
             fromtime (str): start time in format YYYYMMDDHHMM
             totime (str): end time in format YYYYMMDDHHMM
             fname (str): output file name of the recording with .m4a extension
-            
+            debug (bool): run ffmpeg with debug logging
+
         Returns:
-            subprocess.CompletedProcess: ffmpeg process
-            
+            list: ffmpeg command line
         """
-
         assert len(fromtime) == 12, 'fromtime must be in format YYYYMMDDHHMM'
         assert len(totime) == 12, 'totime must be in format YYYYMMDDHHMM'
         # fromtimeとtotimeが過去一週間以内であるかをチェック
         now = datetime.datetime.now()
         week_ago = now - datetime.timedelta(days=7)
-        from_dt = datetime.datetime.strptime(fromtime, '%Y%m%d%H%M')
-        to_dt = datetime.datetime.strptime(totime, '%Y%m%d%H%M')
+        from_dt = _parse_yyyymmddhhmm(fromtime)
+        to_dt = _parse_yyyymmddhhmm(totime)
         assert week_ago <= from_dt <= now, 'fromtime must be within the past week'
         assert week_ago <= to_dt <= now, 'totime must be within the past week'
 
@@ -189,26 +347,116 @@ class RadikoRecorder:
         assert fname.endswith('.m4a'), 'fname must have .m4a extension'
 
         lsid = self.gen_psuedo_hash()
+        ft = fromtime + '00'
+        tt = totime + '00'
         url_download = (
             'https://radiko.jp/v2/api/ts/playlist.m3u8'
-            f'?station_id={station_id}&start_at={fromtime}00&ft={fromtime}00'
-            f'&end_at={totime}00&to={totime}00&seek={fromtime}00&l=15&lsid={lsid}&type=c'
+            f'?station_id={station_id}&start_at={ft}&ft={ft}'
+            f'&end_at={tt}&to={tt}&seek={ft}&l=15&lsid={lsid}&type=c'
+        )
+
+        # the authtoken is kept across recordings; call close() to logout
+        authtoken = self.radiko_util.authorize()
+        return [
+            "ffmpeg",
+            "-loglevel", "debug" if debug else "error",
+            "-fflags", "+discardcorrupt",
+            "-headers", f'X-Radiko-Authtoken: {authtoken}',
+            "-i", url_download,
+            "-acodec", "copy",
+            "-vn",
+            "-bsf:a", "aac_adtstoasc",
+            "-y",
+            fname
+        ]
+
+    def record(
+        self, station_id: str, fromtime: str, totime: str, fname: str,
+        debug: bool = False
+    ) -> subprocess.CompletedProcess:
+        """Record radiko station from fromtime to totime to fname
+        
+        This function uses ffmpeg to record a radiko station
+        for a specified duration and save it as an m4a file.
+        It blocks until ffmpeg exits and can be called from anywhere,
+        including Jupyter. Use `record_async` to run several
+        recordings concurrently.
+        
+        Args:
+            station_id (str): station id
+            fromtime (str): start time in format YYYYMMDDHHMM
+            totime (str): end time in format YYYYMMDDHHMM
+            fname (str): output file name of the recording with .m4a extension
+            debug (bool, optional): run ffmpeg with debug logging and capture
+                the last STDERR_TAIL_BYTES of its stderr. Defaults to False.
+            
+        Returns:
+            subprocess.CompletedProcess: ffmpeg process
+            
+        """
+        command = self._build_command(station_id, fromtime, totime, fname, debug)
+        stderr = None
+        with subprocess.Popen(
+            command,
+            # the recording goes to fname, so stdout carries nothing useful
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE if debug else subprocess.DEVNULL
+        ) as proc:
+            try:
+                if debug:
+                    # keep only the tail so that hours of debug log do not pile up in memory
+                    stderr = _read_tail(proc.stderr)
+                proc.wait()
+            except BaseException:
+                # do not leave ffmpeg writing fname after Ctrl-C
+                proc.kill()
+                raise
+
+        return subprocess.CompletedProcess(command, proc.returncode, None, stderr)
+
+    async def record_async(
+        self, station_id: str, fromtime: str, totime: str, fname: str,
+        debug: bool = False
+    ) -> subprocess.CompletedProcess:
+        """Record radiko station from fromtime to totime to fname
+        
+        Asynchronous version of `record`. The blocking auth requests
+        run in the default executor and ffmpeg runs as an asyncio
+        subprocess, so several recordings can be awaited concurrently
+        with `asyncio.gather`; they share a single authtoken.
+        
+        Args:
+            station_id (str): station id
+            fromtime (str): start time in format YYYYMMDDHHMM
+            totime (str): end time in format YYYYMMDDHHMM
+            fname (str): output file name of the recording with .m4a extension
+            debug (bool, optional): run ffmpeg with debug logging and capture
+                the last STDERR_TAIL_BYTES of its stderr. Defaults to False.
+            
+        Returns:
+            subprocess.CompletedProcess: ffmpeg process
+            
+        """
+        loop = asyncio.get_running_loop()
+        command = await loop.run_in_executor(
+            None, self._build_command, station_id, fromtime, totime, fname, debug
+        )
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            # the recording goes to fname, so stdout carries nothing useful
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE if debug else asyncio.subprocess.DEVNULL
         )
+        stderr = None
+        try:
+            if debug:
+                # keep only the tail so that hours of debug log do not pile up in memory
+                stderr = await _drain_tail(proc.stderr)
+            await proc.wait()
+        except BaseException:
+            # do not leave ffmpeg writing fname after cancellation
+            proc.kill()
+            await proc.wait()
+            raise
 
-        with self.radiko_util as radiko_util:
-            command = [
-                "ffmpeg",
-                "-loglevel", "debug",
-                "-fflags", "+discardcorrupt",
-                "-headers", f'"X-Radiko-Authtoken: {radiko_util.authtoken}"',
-                "-i", f'"{url_download}"',
-                "-acodec", "copy",
-                "-vn",
-                "-bsf:a", "aac_adtstoasc",
-                "-y",
-                fname
-            ]
-            command = ' '.join(command)
-            res = subprocess.run(command, capture_output=True, shell=True, check=False)
-
-        return res
+        return subprocess.CompletedProcess(command, proc.returncode, None, stderr)
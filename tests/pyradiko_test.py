@@ -1,12 +1,21 @@
 import unittest
 import tempfile, os
+import asyncio
+import base64
 import datetime
+import threading
+from unittest import mock
 
 from pyradiko import RadikoRecorder
+from pyradiko.main import (
+    AUTHKEY_VAL, _PARTIALKEYS, _parse_yyyymmddhhmm, _drain_tail, _read_tail,
+    RadikoLoginAuth
+)
 
 class TestRadikoRecorder(unittest.TestCase):
     def test_record(self):
         recorder = RadikoRecorder()
+        self.addCleanup(recorder.close)
         station_id = 'LFR'
         now = datetime.datetime.now()
         totime = (now - datetime.timedelta(minutes=2)).strftime('%Y%m%d%H%M')
@@ -16,5 +25,218 @@ class TestRadikoRecorder(unittest.TestCase):
             self.assertTrue(os.path.exists(f.name))
             self.assertGreater(os.path.getsize(f.name), 0)
 
+    def test_gen_psuedo_hash(self):
+        recorder = RadikoRecorder('dummy@example.com', 'dummy')
+        lsid = recorder.gen_psuedo_hash()
+        self.assertEqual(len(lsid), 32)
+        self.assertRegex(lsid, '^[0-9a-f]{32}$')
+
+    def test_partialkeys(self):
+        for (offset, length), partialkey in _PARTIALKEYS.items():
+            expected = base64.b64encode(AUTHKEY_VAL[offset:offset + length].encode())
+            self.assertEqual(partialkey, expected)
+
+    def test_parse_yyyymmddhhmm(self):
+        for s in ['202309240100', '202312312359', '202402290000']:
+            self.assertEqual(
+                _parse_yyyymmddhhmm(s),
+                datetime.datetime.strptime(s, '%Y%m%d%H%M')
+            )
+        for s in ['202302300000', '202309241460', '202309242500', '20230924010a']:
+            with self.assertRaises(ValueError):
+                _parse_yyyymmddhhmm(s)
+
+    def test_record_rejects_invalid_time(self):
+        recorder = RadikoRecorder('dummy@example.com', 'dummy')
+        now = datetime.datetime.now()
+        yesterday = (now - datetime.timedelta(days=1)).strftime('%Y%m%d')
+        totime = (now - datetime.timedelta(minutes=2)).strftime('%Y%m%d%H%M')
+        week_ago = (now - datetime.timedelta(days=8)).strftime('%Y%m%d%H%M')
+        # field values out of range inside the allowed window
+        for fromtime in [yesterday + '1460', yesterday + '2500']:
+            with self.assertRaises(ValueError):
+                recorder.record('LFR', fromtime, totime, 'out.m4a')
+        # malformed or outside the past week
+        for fromtime in ['2023092401', week_ago]:
+            with self.assertRaises(AssertionError):
+                recorder.record('LFR', fromtime, totime, 'out.m4a')
+        with self.assertRaises(AssertionError):
+            recorder.record('LFR', totime, totime, 'out.mp3')
+
+    def test_drain_tail(self):
+        lines = [f'line {i}\n'.encode() for i in range(10000)]
+        data = b''.join(lines)
+
+        async def drain(limit):
+            stream = asyncio.StreamReader()
+
+            async def feed():
+                # one short write per line, like ffmpeg's debug log
+                for line in lines:
+                    stream.feed_data(line)
+                    await asyncio.sleep(0)
+                stream.feed_eof()
+
+            tail, _ = await asyncio.gather(_drain_tail(stream, limit), feed())
+            return tail
+
+        self.assertEqual(asyncio.run(drain(1000)), data[-1000:])
+        self.assertEqual(asyncio.run(drain(len(data) * 2)), data)
+
+    def test_read_tail(self):
+        lines = [f'line {i}\n'.encode() for i in range(10000)]
+        data = b''.join(lines)
+
+        def read(limit, buffering):
+            read_fd, write_fd = os.pipe()
+
+            def feed():
+                # one short write per line, like ffmpeg's debug log
+                for line in lines:
+                    os.write(write_fd, line)
+                os.close(write_fd)
+
+            thread = threading.Thread(target=feed)
+            thread.start()
+            # buffering=0 returns short reads; the default matches Popen.stderr
+            with open(read_fd, 'rb', buffering=buffering) as stream:
+                tail = _read_tail(stream, limit)
+            thread.join()
+            return tail
+
+        for buffering in [0, -1]:
+            self.assertEqual(read(1000, buffering), data[-1000:])
+            self.assertEqual(read(len(data) * 2, buffering), data)
+
+def fake_login(self):
+    self.radiko_session = f'dummy_session{len(self._stale_sessions)}'
+
+def fake_auth1(self):
+    return 'dummy_token', '0', '16'
+
+class TestRadikoLoginAuth(unittest.TestCase):
+    def setUp(self):
+        self.auth = RadikoLoginAuth('dummy@example.com', 'dummy')
+        self.login = mock.patch.object(
+            RadikoLoginAuth, 'login', autospec=True, side_effect=fake_login
+        ).start()
+        self.auth1 = mock.patch.object(
+            RadikoLoginAuth, 'auth1', autospec=True, side_effect=fake_auth1
+        ).start()
+        self.real_auth2 = RadikoLoginAuth.auth2
+        self.auth2 = mock.patch.object(RadikoLoginAuth, 'auth2', autospec=True).start()
+        self.logout = mock.patch.object(RadikoLoginAuth, 'logout', autospec=True).start()
+        self.addCleanup(mock.patch.stopall)
+        self.calls = mock.Mock()
+        for name in ['login', 'auth1', 'auth2', 'logout']:
+            self.calls.attach_mock(getattr(self, name), name)
+
+    def test_authorize_reuses_token(self):
+        self.assertEqual(self.auth.authorize(), 'dummy_token')
+        self.assertEqual(self.auth.authorize(), 'dummy_token')
+        self.assertEqual(self.login.call_count, 1)
+        self.assertEqual(self.auth1.call_count, 1)
+        self.assertEqual(self.auth2.call_count, 1)
+        self.logout.assert_not_called()
+
+    def test_authorize_after_expiry(self):
+        with mock.patch('pyradiko.main.AUTH_VALID_SECONDS', -1):
+            self.auth.authorize()
+            self.auth.authorize()
+        # recordings may still be using the old token, so it is not logged out
+        self.logout.assert_not_called()
+        self.assertEqual(self.login.call_count, 2)
+        self.assertEqual(self.auth1.call_count, 2)
+        self.assertEqual(self.auth2.call_count, 2)
+        # login and auth1 run concurrently, so only their grouping is fixed
+        names = [name for name, _, _ in self.calls.mock_calls]
+        self.assertEqual(set(names[:3]), {'login', 'auth1', 'auth2'})
+        self.assertEqual(set(names[3:]), {'login', 'auth1', 'auth2'})
+
+    def test_concurrent_records_survive_refresh(self):
+        recorder = RadikoRecorder('dummy@example.com', 'dummy')
+
+        def fake_build_command(recorder, *args):
+            recorder.radiko_util.authorize()
+            # stands in for ffmpeg still pulling HLS with the authtoken
+            return ['sleep', '0.2']
+
+        async def record_both():
+            return await asyncio.gather(
+                recorder.record_async('LFR', '202309240100', '202309240300', 'lfr.m4a'),
+                recorder.record_async('TBS', '202309240100', '202309240300', 'tbs.m4a'),
+            )
+
+        with mock.patch('pyradiko.main.AUTH_VALID_SECONDS', -1), \
+                mock.patch.object(
+                    RadikoRecorder, '_build_command', autospec=True,
+                    side_effect=fake_build_command
+                ):
+            results = asyncio.run(record_both())
+        self.assertEqual([res.returncode for res in results], [0, 0])
+        # the second recording refreshed the token without logging out the first
+        self.assertEqual(self.login.call_count, 2)
+        self.logout.assert_not_called()
+
+        recorder.close()
+        self.logout.assert_has_calls([
+            mock.call(recorder.radiko_util, 'dummy_session0'),
+            mock.call(recorder.radiko_util),
+        ])
+        self.assertEqual(self.logout.call_count, 2)
+
+    def test_close_logs_out_refreshed_sessions(self):
+        recorder = RadikoRecorder('dummy@example.com', 'dummy')
+        radiko_util = recorder.radiko_util
+        with mock.patch('pyradiko.main.AUTH_VALID_SECONDS', -1):
+            radiko_util.authorize()
+            radiko_util.authorize()
+        self.assertEqual(radiko_util.radiko_session, 'dummy_session1')
+        self.logout.assert_not_called()
+
+        recorder.close()
+        self.logout.assert_has_calls([
+            mock.call(radiko_util, 'dummy_session0'),
+            mock.call(radiko_util),
+        ])
+        self.assertEqual(self.logout.call_count, 2)
+
+    def test_authorize_logs_out_when_auth1_fails(self):
+        self.auth1.side_effect = PermissionError('auth1 failed')
+        with self.assertRaises(PermissionError):
+            self.auth.authorize()
+        self.login.assert_called_once_with(self.auth)
+        self.logout.assert_called_once_with(self.auth)
+        self.auth2.assert_not_called()
+
+    @mock.patch('pyradiko.main.AUTH_VALID_SECONDS', -1)
+    def test_refresh_publishes_token_after_auth2(self):
+        self.auth.authorize()
+        self.auth1.side_effect = lambda auth: ('new_token', '0', '16')
+
+        def failing_auth2(auth, *args):
+            # concurrent recordings must still see the active token here
+            self.assertEqual(auth.authtoken, 'dummy_token')
+            raise PermissionError('auth2 failed')
+
+        self.auth2.side_effect = failing_auth2
+        with self.assertRaises(PermissionError):
+            self.auth.authorize()
+        self.assertEqual(self.auth.authtoken, 'dummy_token')
+
+        self.auth2.side_effect = None
+        self.assertEqual(self.auth.authorize(), 'new_token')
+        self.assertEqual(self.auth.authtoken, 'new_token')
+
+    def test_auth2_rejects_unknown_partialkey(self):
+        # slices outside AUTHKEY_VAL have no partialkey
+        for keyoffset, keylength in [('0', '0'), ('30', '16')]:
+            self.auth.radiko_session = 'dummy_session'
+            with mock.patch.object(self.auth.session, 'get') as get:
+                with self.assertRaises(PermissionError):
+                    self.real_auth2(self.auth, 'dummy_token', keyoffset, keylength)
+                get.assert_not_called()
+        self.assertEqual(self.logout.call_count, 2)
+
 if __name__ == '__main__':
     unittest.main()